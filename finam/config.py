@@ -1,2 +1,16 @@
+import os.path
+
 FINAM_CHARSET = 'cp1251'
 FINAM_TRUSTED_USER_AGENT = 'Mozilla/5.0'
+# finam.ru site itself is picky, so meta data is requested like a real browser does
+FINAM_BROWSER_HEADERS = {
+    'User-Agent': ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+                   '(KHTML, like Gecko) Chrome/118.0.0.0 Safari/537.36'),
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
+    'Referer': 'https://www.finam.ru/',
+}
+
+# meta data rarely changes, so it's cached on disk between runs
+FINAM_META_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'finam-export', 'meta.pickle')
+FINAM_META_CACHE_TTL = 24 * 60 * 60
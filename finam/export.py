@@ -1,29 +1,40 @@
+import atexit
 import datetime
+import functools
+import io
+import itertools
 import logging
-import operator
+import os
+import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from enum import IntEnum
-from io import StringIO
-from typing import Type, Union
+from typing import Union
 from urllib.parse import urlencode
-from urllib.request import urlopen
 
+import numpy as np
 import pandas as pd
+import requests
 from pandas.errors import ParserError
+from requests.adapters import HTTPAdapter
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.chrome.webdriver import WebDriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
+from urllib3.util.retry import Retry
 from webdriver_manager.chrome import ChromeDriverManager
 
+from .config import (FINAM_BROWSER_HEADERS, FINAM_CHARSET, FINAM_META_CACHE_PATH,
+                     FINAM_META_CACHE_TTL)
 from .const import Timeframe
 from .exception import (FinamAlreadyInProgressError, FinamDownloadError,
                         FinamObjectNotFoundError, FinamParsingError,
                         FinamThrottlingError, FinamTooLongTimeframeError)
 from .interval import split_interval
-from .utils import (build_trusted_request, is_container, parse_script_link,
-                    smart_decode)
+from .utils import (IterStream, RateLimiter, build_trusted_request, is_container,
+                    parse_script_link, smart_decode, smart_encode)
 
 __all__ = ['Exporter', 'LookupComparator']
 
@@ -38,31 +49,132 @@ class LookupComparator(IntEnum):
     CONTAINS = 3
 
 
-def fetch_url_urllib(url, lines=False):
+def _build_session(pool_maxsize=16):
+    """
+    Builds a keep-alive session so that consecutive requests
+    to the same host reuse a pooled connection
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=4, pool_maxsize=pool_maxsize, max_retries=Retry(total=0)
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+_SESSION = _build_session()
+
+
+def _iter_response(url, resp, chunk_size):
+    try:
+        yield from resp.iter_content(chunk_size)
+    except requests.RequestException as e:
+        raise FinamDownloadError('Unable to load {}: {}'.format(url, e))
+    finally:
+        resp.close()
+
+
+def fetch_url_urllib(url, lines=False, decode=False, session=None, stream=False):
     """
     Fetches url from finam.ru
     Since January 2023 this fetcher does not support fetching meta data
+
+    Despite the name it uses a shared requests session under the hood,
+    so chunked downloads don't pay for a new connection every time
+
+    The response is returned as raw bytes in FINAM_CHARSET, unless decode=True
+    With stream=True it's an iterator of raw chunks as they arrive,
+    close it if it's not consumed till the end
+    A custom session may be passed instead of the shared one
     """
     logger.info('Fetching {}'.format(url))
-    request = build_trusted_request(url)
+    if session is None:
+        session = _SESSION
+    headers = build_trusted_request(url).headers
     try:
-        fh = urlopen(request)
-        if lines:
-            response = fh.readlines()
-        else:
-            response = fh.read()
-    except IOError as e:
+        resp = session.get(url, headers=headers, timeout=30, stream=stream)
+    except requests.RequestException as e:
+        raise FinamDownloadError('Unable to load {}: {}'.format(url, e))
+    try:
+        resp.raise_for_status()
+    except requests.RequestException as e:
+        # streamed response would hold its connection otherwise
+        resp.close()
+        raise FinamDownloadError('Unable to load {}: {}'.format(url, e))
+    if stream:
+        return _iter_response(url, resp, 65536)
+    if lines:
+        response = resp.content.splitlines(keepends=True)
+    else:
+        response = resp.content
+    if not decode:
+        return response
+    try:
+        return smart_decode(response)
+    except UnicodeDecodeError as e:
+        raise FinamDownloadError('Unable to decode: {}'.format(e))
+
+
+_META_SESSION = None
+_META_SESSION_LOCK = threading.Lock()
+
+
+def _get_meta_session():
+    """
+    Builds a browser-like session on first use
+
+    finam.ru front page is visited once to collect cookies
+    a real browser would have by the time it requests meta data
+    """
+    global _META_SESSION
+    with _META_SESSION_LOCK:
+        if _META_SESSION is None:
+            session = _build_session()
+            session.headers.update(FINAM_BROWSER_HEADERS)
+            session.get(ExporterMetaPage.FINAM_BASE, timeout=30)
+            _META_SESSION = session
+    return _META_SESSION
+
+
+def fetch_url_requests(url, lines=False, decode=False):
+    """
+    Fetches url from finam.ru
+    Plain HTTP method for meta data fetching mimicking a browser
+
+    Falls back to the much slower webdriver based method
+    if finam.ru denies access anyway
+    The response is returned as raw bytes, unless decode=True
+    """
+    logger.info('Fetching {}'.format(url))
+    try:
+        resp = _get_meta_session().get(url, timeout=30)
+        if resp.status_code == 403:
+            logger.info('Access denied, falling back to webdriver')
+            return fetch_url_webdriver(url, lines=lines, decode=decode)
+        resp.raise_for_status()
+    except requests.RequestException as e:
         raise FinamDownloadError('Unable to load {}: {}'.format(url, e))
+    if not lines:
+        if decode:
+            # html pages are not necessarily in FINAM_CHARSET
+            return resp.text
+        return resp.content
+    response = resp.content.splitlines(keepends=True)
+    if not decode:
+        return response
     try:
         return smart_decode(response)
     except UnicodeDecodeError as e:
-        raise FinamDownloadError('Unable to decode: {}'.format(e.message))
+        raise FinamDownloadError('Unable to decode: {}'.format(e))
 
 
-def fetch_url_webdriver(url, lines=False) -> str:
+def fetch_url_webdriver(url, lines=False, decode=False):
     """
     Fetches url from finam.ru
     Selenium webdriver based method for meta data fetching
+
+    The page is returned as raw bytes in FINAM_CHARSET, unless decode=True
     """
     logger.info('Fetching {}'.format(url))
     locator = (By.XPATH, "//*")
@@ -71,37 +183,29 @@ def fetch_url_webdriver(url, lines=False) -> str:
         res = fetcher.wait.until(
             lambda driver: driver.find_element(*locator).get_attribute('outerHTML')
         )
-        if lines:
-            res = res.encode('cp1252').decode('cp1251')
-            res = res.split('\n')
-            return res
+    if lines:
+        # browser decodes finam's cp1251 js as cp1252, so undoing it gives original bytes
+        res = res.encode('cp1252').split(b'\n')
+        return smart_decode(res) if decode else res
+    if decode:
         return res
-
-
-def use_fetcher_meta(cls: Type) -> Type:
-    """
-    It is class decorator.
-    Use it to decorate all classes that should use webdriver for fetching
-    """
-    FetchMetaWebriver.pages_to_load_max += 1
-    return cls
+    # rendered page is unicode already, there are no original bytes to return
+    return res.encode(FINAM_CHARSET, errors='replace')
 
 
 class FetchMetaWebriver:
     """
     This class provides a method for fetching meta data from the finam.ru website
     The method is based on the Selenium webdriver and uses a cached webdriver stored as a class attribute driver
-    This caching saves around 1-2 seconds of loading time
-    The number of pages to download is dynamically calculated using a class decorator and stored in the pages_to_load_max attribute
-    Attribute pages_to_load is used to support multiple Exporter instances
-    The webdriver is automatically closed when all pages have been downloaded
+    The webdriver is started once and shared by all Exporter instances, saving a browser launch per instance
+    It is closed on interpreter exit or as soon as fetching fails
+    The lock serializes access to the driver as it can't be used from multiple threads at once
     """
 
     driver: Union[WebDriver, None] = None
-    pages_to_load_max = 0
-    pages_to_load_cur = {}
     timeout = 30
     wait: WebDriverWait
+    lock = threading.RLock()
 
     def __enter__(self):
         """
@@ -111,8 +215,18 @@ class FetchMetaWebriver:
         If you are going to use this lib inside docker container you have to use virtual screen, e.g. xvfb
         """
         cls = self.__class__
-        if cls.driver and cls.pages_to_load_cur[id(cls.driver)] > 0:
+        cls.lock.acquire()
+        if cls.driver is not None:
             return self
+        try:
+            cls._start()
+        except BaseException:
+            cls.lock.release()
+            raise
+        return self
+
+    @classmethod
+    def _start(cls):
         logger.info(f'Meta data fetching started')
         chromeService = Service(ChromeDriverManager(log_level=logging.WARNING).install())
         options = webdriver.ChromeOptions()
@@ -133,21 +247,29 @@ class FetchMetaWebriver:
         # Setup driver and cache it inside the class
         cls.driver = webdriver.Chrome(service=chromeService, options=options)
         cls.wait = WebDriverWait(cls.driver, cls.timeout)
-        cls.pages_to_load_cur[id(self.driver)] = cls.pages_to_load_max
-        return self
+
+    @classmethod
+    def quit(cls):
+        with cls.lock:
+            if cls.driver is not None:
+                cls.driver.quit()
+                cls.driver = None
+                logger.info('Meta data fetching finished')
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         cls = self.__class__
-        cls.pages_to_load_cur[id(self.driver)] -= 1
-        if any((exc_type, exc_val, exc_tb)):
-            self.driver.quit()
-            logger.info(f'Meta data fetching failed. {exc_type}): {exc_val}')
-        if cls.pages_to_load_cur[id(self.driver)] == 0:
-            self.driver.quit()
-            logger.info('Meta data fetching finished')
- 
-
-@use_fetcher_meta
+        try:
+            if any((exc_type, exc_val, exc_tb)):
+                logger.info(f'Meta data fetching failed. {exc_type}): {exc_val}')
+                # the browser may be left in a broken state, start afresh next time
+                cls.quit()
+        finally:
+            cls.lock.release()
+
+
+atexit.register(FetchMetaWebriver.quit)
+
+
 class ExporterMetaPage(object):
 
     FINAM_BASE = 'https://www.finam.ru'
@@ -168,7 +290,7 @@ class ExporterMetaPage(object):
         <script src="/somepath/icharts.js" type="text/javascript"></script>
         into raw HTML page code
         """
-        html = self._fetcher(self.FINAM_ENTRY_URL)
+        html = self._fetcher(self.FINAM_ENTRY_URL, decode=True)
         try:
             url = parse_script_link(html, self.FINAM_META_FILENAME)
         except ValueError as e:
@@ -176,7 +298,6 @@ class ExporterMetaPage(object):
         return self.FINAM_BASE + url
 
 
-@use_fetcher_meta
 class ExporterMetaFile(object):
 
     FINAM_CATEGORIES = -1
@@ -194,79 +315,159 @@ class ExporterMetaFile(object):
         var ints_arr = [int1,...,intN]
 
         May also contain empty strings ['abc','','']
+        The line is raw bytes, only string items get decoded
         """
         logger.debug('Parsing line starting with "{}"'.format(line[:20]))
 
         # extracting everything between array brackets
-        start_char, end_char = '[', ']'
+        start_char, end_char = b'[', b']'
         start_idx = line.find(start_char)
-        end_idx = line.find(end_char)
-        if start_idx == -1 or end_idx == -1:
+        # names may contain brackets themselves
+        end_idx = line.rfind(end_char)
+        if start_idx == -1 or end_idx < start_idx:
             raise FinamDownloadError('Unable to parse line: {}'.format(line))
         items = line[start_idx + 1 : end_idx]
 
         # string items
-        if items.startswith("'"):
+        if items.startswith(b"'"):
             # it may contain ',' inside lines so cant split by ','
             # i.e. "GILEAD SCIENCES, INC."
-            items = items.split("','")
-            for i in (0, -1):
-                items[i] = items[i].strip("'")
-            return items
+            # outer quotes are sliced off rather than stripped
+            # as a name may end with an escaped quote
+            # decoding once as a whole is much cheaper than item by item
+            try:
+                return smart_decode(items[1:-1]).split("','")
+            except UnicodeDecodeError as e:
+                raise FinamDownloadError('Unable to decode: {}'.format(e))
 
-        # int items
-        return items.split(',')
+        # int items, int() takes bytes just fine
+        return items.split(b',')
 
     def _parse_js(self, data):
         """
         Parses js file used by finam.ru export tool
+
+        Junk category rows are masked out of the parsed arrays
+        so the dataframe is built once from what's left
         """
-        cols = ('id', 'name', 'code', 'market')
-        parsed = dict()
-        for idx, col in enumerate(cols[: len(cols)]):
-            parsed[col] = self._parse_js_assignment(data[idx])
-        df = pd.DataFrame(columns=cols, data=parsed)
-        df['market'] = df['market'].astype(int)
+        ids, names, codes, markets = [self._parse_js_assignment(line) for line in data[:4]]
+        markets = np.array(markets).astype(np.int64)
         # junk data + non-int ids, we don't need it
-        df = df[df.market != self.FINAM_CATEGORIES]
+        mask = markets != self.FINAM_CATEGORIES
         # now we can coerce ids to ints
-        df['id'] = df['id'].astype(int)
-        df.set_index('id', inplace=True)
-        df.sort_values('market', inplace=True)
-        return df
+        index = pd.Index(np.array(ids)[mask].astype(np.int64), name='id')
+        df = pd.DataFrame(
+            {
+                'name': np.array(names, dtype=object)[mask],
+                'code': np.array(codes, dtype=object)[mask],
+                'market': markets[mask],
+            },
+            index=index,
+        )
+        df.sort_values('market', kind='stable', inplace=True)
+        # few distinct values, lookups compare integer codes then
+        return df.astype({'code': 'category', 'market': 'category'})
 
     def parse_df(self):
         response = self._fetcher(self._url, lines=True)
         return self._parse_js(response)
 
 
+# meta data loaded within the current process with its load time, by fetcher
+_META_CACHE = {}
+
+
 class ExporterMeta(object):
-    def __init__(self, lazy=True, fetcher=fetch_url_urllib):
+    """
+    Meta data is memoized in-process and, if cache_path is given,
+    stored on disk for cache_ttl seconds to avoid fetching it on every run
+    Once cache_ttl is over it's reloaded by the next lookup
+
+    Results of the latest lookups are cached as well
+    """
+
+    LOOKUP_CACHE_SIZE = 256
+
+    def __init__(
+        self, lazy=True, fetcher=fetch_url_urllib, cache_path=None, cache_ttl=FINAM_META_CACHE_TTL
+    ):
         self._meta = None
         self._fetcher = fetcher
+        self._cache_path = cache_path
+        self._cache_ttl = cache_ttl
+        self._lookup_cached = None
+        self._loaded_at = None
         if not lazy:
             self._load()
 
     def _load(self):
-        if self._meta is not None:
+        if self._meta is not None and time.time() - self._loaded_at <= self._cache_ttl:
             return self._meta
-        page = ExporterMetaPage(self._fetcher)
-        meta_url = page.find_meta_file()
-        meta_file = ExporterMetaFile(meta_url, self._fetcher)
-        self._meta = meta_file.parse_df()
+        meta = None
+        loaded_at, cached = _META_CACHE.get(self._fetcher, (None, None))
+        if cached is not None and time.time() - loaded_at <= self._cache_ttl:
+            meta = cached
+        else:
+            meta, loaded_at = self._load_cache()
+        if meta is None:
+            page = ExporterMetaPage(self._fetcher)
+            meta_url = page.find_meta_file()
+            meta_file = ExporterMetaFile(meta_url, self._fetcher)
+            meta = meta_file.parse_df()
+            loaded_at = time.time()
+            self._save_cache(meta)
+        _META_CACHE[self._fetcher] = (loaded_at, meta)
+        self._meta = meta
+        self._loaded_at = loaded_at
+        # cached lookups are bound to the meta data they were made against
+        self._lookup_cached = functools.lru_cache(maxsize=self.LOOKUP_CACHE_SIZE)(self._lookup)
+
+    def _load_cache(self):
+        """
+        Returns meta data stored on disk along with the time it was saved
+        or (None, None) if there's no fresh copy
+        """
+        if self._cache_path is None:
+            return None, None
+        try:
+            saved_at = os.path.getmtime(self._cache_path)
+        except OSError:
+            return None, None
+        if time.time() - saved_at > self._cache_ttl:
+            logger.info('Meta data cache {} is expired'.format(self._cache_path))
+            return None, None
+        try:
+            meta = pd.read_pickle(self._cache_path)
+        except Exception as e:
+            logger.warning('Unable to read meta data cache {}: {}'.format(self._cache_path, e))
+            return None, None
+        logger.info('Meta data loaded from cache {}'.format(self._cache_path))
+        return meta, saved_at
+
+    def _save_cache(self, meta):
+        if self._cache_path is None:
+            return
+        # writing to a temporary file first not to leave a broken cache behind
+        tmp_path = '{}.{}.tmp'.format(self._cache_path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self._cache_path), exist_ok=True)
+            meta.to_pickle(tmp_path)
+            os.replace(tmp_path, self._cache_path)
+        except OSError as e:
+            logger.warning('Unable to write meta data cache {}: {}'.format(self._cache_path, e))
 
     @property
     def meta(self):
-        try:
-            return self._meta.copy(deep=True)
-        except AttributeError:
-            return None
+        """
+        Loaded meta data, it's shared rather than copied so treat it as read-only
+        """
+        return self._meta
 
-    def _apply_filter(self, col, val, comparator):
+    def _apply_filter(self, df, col, val, comparator):
         """
-        Builds a dataframe matching original dataframe with conditions passed
+        Builds a boolean mask matching dataframe with conditions passed
 
-        The original dataframe is left intact
+        The dataframe is left intact
         """
         if not is_container(val):
             val = [val]
@@ -274,23 +475,29 @@ class ExporterMeta(object):
         if comparator == LookupComparator.EQUALS:
             # index must be sliced differently
             if col == 'id':
-                expr = self._meta.index.isin(val)
+                expr = df.index.isin(val)
             else:
-                expr = self._meta[col].isin(val)
+                expr = df[col].isin(val)
         else:
+            # a single regex pass instead of a scan per value
+            pattern = '|'.join(map(re.escape, val))
             if comparator == LookupComparator.STARTSWITH:
-                op = 'startswith'
-            else:
-                op = 'contains'
-            expr = self._combine_filters(map(getattr(self._meta[col].str, op), val), operator.or_)
-        return expr
+                pattern = '^(?:{})'.format(pattern)
+            expr = df[col].str.contains(pattern, regex=True, na=False)
+        # plain arrays skip index alignment when slicing with them
+        return np.asarray(expr, dtype=bool)
 
-    def _combine_filters(self, filters, op):
-        itr = iter(filters)
-        result = next(itr)
-        for filter_ in itr:
-            result = op(result, filter_)
-        return result
+    @staticmethod
+    def _canonical(val):
+        """
+        Makes equal lookup values share the same cache key
+        """
+        if not is_container(val):
+            return val
+        try:
+            return tuple(sorted(set(val)))
+        except TypeError:
+            return tuple(val)
 
     def lookup(
         self,
@@ -312,29 +519,47 @@ class ExporterMeta(object):
             raise ValueError('Either id or code or name or market' ' must be specified')
 
         self._load()
-        filters = []
-
-        # applying filters
+        args = tuple(map(self._canonical, (id_, code, name, market)))
+        args += (name_comparator, code_comparator)
+        try:
+            hash(args)
+        except TypeError:
+            res = self._lookup(*args)
+        else:
+            res = self._lookup_cached(*args)
+        # categoricals are internal to matching, callers get plain columns;
+        # astype copies so the cached result can't be changed by the caller
+        return res.astype({'code': object, 'market': int})
+
+    def _lookup(self, id_, code, name, market, name_comparator, code_comparator):
+        # applying filters one by one to what's left after the previous ones
+        # cheap integer comparisons go first so that string matching
+        # has to scan as few rows as possible
         filter_groups = (
             ('id', id_, LookupComparator.EQUALS),
+            ('market', market, LookupComparator.EQUALS),
             ('code', code, code_comparator),
             ('name', name, name_comparator),
-            ('market', market, LookupComparator.EQUALS),
         )
 
+        res = self._meta
         for col, val, comparator in filter_groups:
-            if val is not None:
-                filters.append(self._apply_filter(col, val, comparator))
-
-        combined_filter = self._combine_filters(filters, operator.and_)
-        res = self._meta[combined_filter]
-        if len(res) == 0:
-            raise FinamObjectNotFoundError
+            if val is None:
+                continue
+            res = res[self._apply_filter(res, col, val, comparator)]
+            if len(res) == 0:
+                raise FinamObjectNotFoundError
         return res
 
 
 class Exporter(object):
 
+    """
+    With the default fetcher every instance owns a connection pool
+    shared by concurrent chunk downloads, release it with close()
+    or by using the instance as a context manager
+    """
+
     DEFAULT_EXPORT_HOST = 'export.finam.ru'
     IMMUTABLE_PARAMS = {
         'd': 'd',
@@ -353,52 +578,185 @@ class Exporter(object):
     EMPTY_RESULT_NOT_TICKS = '<DATE>;<TIME>;<OPEN>;<HIGH>;<LOW>;<CLOSE>;<VOL>'
     EMPTY_RESULT_TICKS = '<TICKER>;<PER>;<DATE>;<TIME>;<LAST>;<VOL>'
 
+    # known upfront so pandas doesn't have to infer them for every chunk
+    # <VOL> is left out as it may be fractional for some markets
+    DTYPES_NOT_TICKS = {
+        '<DATE>': 'int64',
+        '<TIME>': 'object',
+        '<OPEN>': 'float64',
+        '<HIGH>': 'float64',
+        '<LOW>': 'float64',
+        '<CLOSE>': 'float64',
+    }
+    DTYPES_TICKS = {
+        '<TICKER>': 'object',
+        '<DATE>': 'int64',
+        '<LAST>': 'float64',
+    }
+
     ERROR_TOO_MUCH_WANTED = u'Вы запросили данные за слишком ' u'большой временной период'
 
     ERROR_THROTTLING = 'Forbidden: Access is denied'
     ERROR_ALREADY_IN_PROGRESS = u'Система уже обрабатывает Ваш запрос'
 
+    # error pages are tiny, no need to scan a whole csv looking for errors
+    SANITY_CHECK_SIZE = 4096
+    _ERRORS = {
+        smart_encode(ERROR_TOO_MUCH_WANTED): FinamTooLongTimeframeError,
+        smart_encode(ERROR_THROTTLING): FinamThrottlingError,
+        smart_encode(ERROR_ALREADY_IN_PROGRESS): FinamAlreadyInProgressError,
+    }
+    _ERRORS_RE = re.compile(b'|'.join(map(re.escape, _ERRORS)))
+
     def __init__(
-        self, export_host=None, fetcher=fetch_url_urllib, fetcher_meta=fetch_url_webdriver
+        self,
+        export_host=None,
+        fetcher=fetch_url_urllib,
+        fetcher_meta=fetch_url_requests,
+        meta_cache_path=FINAM_META_CACHE_PATH,
+        meta_cache_ttl=FINAM_META_CACHE_TTL,
     ):
-        self._meta = ExporterMeta(lazy=True, fetcher=fetcher_meta)
+        self._meta = ExporterMeta(
+            lazy=True, fetcher=fetcher_meta, cache_path=meta_cache_path, cache_ttl=meta_cache_ttl
+        )
+        self._session = None
+        if fetcher is fetch_url_urllib:
+            self._session = _build_session()
+            fetcher = functools.partial(fetch_url_urllib, session=self._session)
         self._fetcher = fetcher
         if export_host is not None:
             self._export_host = export_host
         else:
             self._export_host = self.DEFAULT_EXPORT_HOST
+        self._url_prefix = 'http://{}/table.csv?{}&'.format(
+            self._export_host, urlencode(self.IMMUTABLE_PARAMS)
+        )
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     def _build_url(self, params):
-        url = 'http://{}/table.csv?{}&{}'.format(
-            self._export_host, urlencode(self.IMMUTABLE_PARAMS), urlencode(params)
-        )
-        return url
+        return self._url_prefix + urlencode(params)
 
     def _postprocess(self, data, timeframe):
-        if data == '':
+        """
+        Operates on raw bytes as returned by the fetcher
+        """
+        if data == b'':
             if timeframe == timeframe.TICKS:
-                return self.EMPTY_RESULT_TICKS
-            return self.EMPTY_RESULT_NOT_TICKS
+                return smart_encode(self.EMPTY_RESULT_TICKS)
+            return smart_encode(self.EMPTY_RESULT_NOT_TICKS)
         return data
 
     def _sanity_check(self, data):
-        if self.ERROR_TOO_MUCH_WANTED in data:
-            raise FinamTooLongTimeframeError
-
-        if self.ERROR_THROTTLING in data:
-            raise FinamThrottlingError
+        """
+        Operates on raw bytes as returned by the fetcher
+        so the whole csv doesn't have to be decoded just to be checked
 
-        if self.ERROR_ALREADY_IN_PROGRESS in data:
-            raise FinamAlreadyInProgressError
+        Only the beginning of data is looked at
+        """
+        head = data[: self.SANITY_CHECK_SIZE]
+        match = self._ERRORS_RE.search(head)
+        if match is not None:
+            raise self._ERRORS[match.group()]
 
-        if not all(c in data for c in '<>;'):
+        if not all(c in head for c in (b'<', b'>', b';')):
             raise FinamParsingError(
-                'Returned data doesnt seem like ' 'a valid csv dataset: {}'.format(data)
+                'Returned data doesnt seem like '
+                'a valid csv dataset: {}'.format(head.decode(FINAM_CHARSET, errors='replace'))
             )
 
     def lookup(self, *args, **kwargs):
         return self._meta.lookup(*args, **kwargs)
 
+    def _read_head(self, stream):
+        head = b''
+        for chunk in stream:
+            head += chunk
+            if len(head) >= self.SANITY_CHECK_SIZE:
+                break
+        return head
+
+    def _parse_chunk(self, head, stream, timeframe):
+        """
+        Parses already read head of the csv followed by the rest of the stream
+        """
+        try:
+            if timeframe == Timeframe.TICKS:
+                dtypes = self.DTYPES_TICKS
+            else:
+                dtypes = self.DTYPES_NOT_TICKS
+            fh = io.BufferedReader(IterStream(itertools.chain((head,), stream)))
+            chunk_df = pd.read_csv(fh, sep=';', engine='c', dtype=dtypes, encoding=FINAM_CHARSET)
+            chunk_df.sort_index(inplace=True)
+        except (ParserError, ValueError) as e:
+            # ValueError comes from values not matching known dtypes
+            raise FinamParsingError(e)
+        return chunk_df
+
+    def _open_stream(self, url):
+        """
+        Returns an iterator of raw response chunks
+
+        Only the default fetcher streams, custom ones are called
+        just with url and may return the whole response as str or bytes
+        """
+        if self._session is not None:
+            return self._fetcher(url, stream=True)
+        data = self._fetcher(url)
+        if isinstance(data, str):
+            data = smart_encode(data)
+        if isinstance(data, bytes):
+            return iter((data,))
+        return iter(data)
+
+    def _fetch_one_chunk(
+        self, url, counter, total, timeframe, delay, max_in_progress_retries, limiter
+    ):
+        """
+        Downloads and parses a single chunk, retrying while finam
+        reports the request is already in progress
+        Retries are spaced out by the limiter just like any other request,
+        the limiter counts delay from the moment a request is over
+
+        The response is streamed right into pandas once its head
+        passes the sanity check, so it's never held in memory as a whole
+        """
+        # deliberately not using pd.read_csv's ability to fetch
+        # urls to fully control what's happening
+        retries = 0
+        while True:
+            limiter.wait()
+            logger.info('Processing chunk %d of %d', counter, total)
+            stream = self._open_stream(url)
+            try:
+                head = self._postprocess(self._read_head(stream), timeframe)
+                try:
+                    self._sanity_check(head)
+                except FinamAlreadyInProgressError:
+                    if retries <= max_in_progress_retries:
+                        retries += 1
+                        logger.info(
+                            'Finam work is in progress, waiting'
+                            ' for {} second(s) before retry #{}'.format(delay, retries)
+                        )
+                        continue
+                    else:
+                        raise
+                return self._parse_chunk(head, stream, timeframe)
+            finally:
+                # releases the connection if the response wasn't read in full
+                if hasattr(stream, 'close'):
+                    stream.close()
+                limiter.done()
+
     def download(
         self,
         id_,
@@ -409,7 +767,19 @@ class Exporter(object):
         delay=1,
         max_in_progress_retries=10,
         fill_empty=False,
+        max_workers=1,
     ):
+        """
+        Downloads data for the given contract
+
+        Long intervals are split into chunks, each request starts
+        at least delay seconds after the previous one is over
+        to keep finam from throttling us
+
+        Chunks may be fetched concurrently by up to max_workers threads
+        but finam tends to reply with ERROR_ALREADY_IN_PROGRESS
+        to overlapping requests, so it's off by default
+        """
         items = self._meta.lookup(id_=id_, market=market)
         # i.e. for markets 91, 519, 2
         # id duplicates are feasible, looks like corrupt data on finam
@@ -421,65 +791,57 @@ class Exporter(object):
         if end_date is None:
             end_date = datetime.date.today()
 
-        df = None
+        # params shared by all chunks, only dates differ
+        base_params = {
+            'p': timeframe.value,
+            'em': id_,
+            'market': market.value,
+            'cn': code,
+            'code': code,
+            # I would guess this param denotes 'data format'
+            # that differs for ticks only
+            'datf': 6 if timeframe == Timeframe.TICKS else 5,
+            'fsp': 1 if fill_empty else 0,
+        }
+        urls = []
         chunks = split_interval(start_date, end_date, timeframe.value)
-        counter = 0
         for chunk_start_date, chunk_end_date in chunks:
-            counter += 1
-            logger.info('Processing chunk %d of %d', counter, len(chunks))
-            if counter > 1:
-                logger.info('Sleeping for {} second(s)'.format(delay))
-                time.sleep(delay)
-
-            params = {
-                'p': timeframe.value,
-                'em': id_,
-                'market': market.value,
-                'df': chunk_start_date.day,
-                'mf': chunk_start_date.month - 1,
-                'yf': chunk_start_date.year,
-                'dt': chunk_end_date.day,
-                'mt': chunk_end_date.month - 1,
-                'yt': chunk_end_date.year,
-                'cn': code,
-                'code': code,
-                # I would guess this param denotes 'data format'
-                # that differs for ticks only
-                'datf': 6 if timeframe == Timeframe.TICKS.value else 5,
-                'fsp': 1 if fill_empty else 0,
-            }
-
-            url = self._build_url(params)
-            # deliberately not using pd.read_csv's ability to fetch
-            # urls to fully control what's happening
-            retries = 0
-            while True:
-                data = self._fetcher(url)
-                data = self._postprocess(data, timeframe)
-                try:
-                    self._sanity_check(data)
-                except FinamAlreadyInProgressError:
-                    if retries <= max_in_progress_retries:
-                        retries += 1
-                        logger.info(
-                            'Finam work is in progress, sleeping'
-                            ' for {} second(s) before retry #{}'.format(delay, retries)
-                        )
-                        time.sleep(delay)
-                        continue
-                    else:
-                        raise
-                break
-
+            params = base_params.copy()
+            params.update(
+                df=chunk_start_date.day,
+                mf=chunk_start_date.month - 1,
+                yf=chunk_start_date.year,
+                dt=chunk_end_date.day,
+                mt=chunk_end_date.month - 1,
+                yt=chunk_end_date.year,
+            )
+            urls.append(self._build_url(params))
+
+        limiter = RateLimiter(delay)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = []
+            for counter, url in enumerate(urls, 1):
+                futures.append(
+                    executor.submit(
+                        self._fetch_one_chunk,
+                        url,
+                        counter,
+                        len(urls),
+                        timeframe,
+                        delay,
+                        max_in_progress_retries,
+                        limiter,
+                    )
+                )
+
+            # results are collected in submit order to keep chunks sorted
             try:
-                chunk_df = pd.read_csv(StringIO(data), sep=';')
-                chunk_df.sort_index(inplace=True)
-            except ParserError as e:
-                raise FinamParsingError(e)
-
-            if df is None:
-                df = chunk_df
-            else:
-                df = pd.concat((df, chunk_df))
-
-        return df
+                chunks_dfs = [future.result() for future in futures]
+            except Exception:
+                # no point in downloading the rest if a chunk has failed
+                for future in futures:
+                    future.cancel()
+                raise
+
+        # concatenating once as growing the result chunk by chunk is quadratic
+        return pd.concat(chunks_dfs, sort=False, copy=False)
@@ -1,5 +1,8 @@
+import io
 import re
 import six
+import threading
+import time
 from collections.abc import Container
 from operator import attrgetter
 from urllib.request import Request
@@ -47,6 +50,66 @@ def parse_script_link(html, src_entry):
     return match.group(1)
 
 
+class RateLimiter(object):
+
+    """
+    Thread-safe throttle allowing at most one call per interval seconds
+
+    Every caller of wait() is given its own time slot, slots are
+    interval seconds apart from each other
+    Calling done() once a call is over pushes the next slot
+    interval seconds after that moment, so a slow call is still
+    followed by a full pause
+    """
+
+    def __init__(self, interval):
+        self._interval = interval
+        self._next_allowed_ts = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_allowed_ts)
+            self._next_allowed_ts = slot + self._interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def done(self):
+        with self._lock:
+            self._next_allowed_ts = max(self._next_allowed_ts,
+                                        time.monotonic() + self._interval)
+
+
+class IterStream(io.RawIOBase):
+
+    """
+    Read-only binary file-like object over an iterable of bytes chunks
+
+    Lets consumers expecting a file, i.e. pandas, read data
+    as it arrives instead of buffering it all first
+    """
+
+    def __init__(self, iterable):
+        self._iter = iter(iterable)
+        self._leftover = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        chunk = self._leftover
+        while not chunk:
+            try:
+                chunk = next(self._iter)
+            except StopIteration:
+                return 0
+        size = len(b)
+        output, self._leftover = chunk[:size], chunk[size:]
+        b[: len(output)] = output
+        return len(output)
+
+
 def click_validate_enum(enumClass, ctx, param, value):
     if value is not None:
         try:
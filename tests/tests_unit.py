@@ -1,25 +1,81 @@
+import io
 import operator
+import os
+import tempfile
+import threading
+import time
 import unittest
 import unittest.mock as mock
 from datetime import date
+from io import StringIO
 
 import pandas as pd
+import requests
 from parameterized import parameterized
 
-from finam import (Market,
+from finam import (Exporter,
+                   Market,
                    Timeframe,
                    LookupComparator,
                    FinamDownloadError,
                    FinamParsingError,
+                   FinamThrottlingError,
                    FinamObjectNotFoundError)
-from finam.export import (ExporterMeta,
+from finam.export import (fetch_url_requests,
+                          fetch_url_urllib,
+                          ExporterMeta,
                           ExporterMetaPage,
                           ExporterMetaFile)
 from finam.interval import split_interval
+from finam.utils import IterStream, RateLimiter, smart_encode
 
 from fixtures import fixtures, startswith_compat, SBER, MICEX
 
 
+class TestFetchUrlRequests(unittest.TestCase):
+
+    URL = 'https://www.finam.ru/cache/icharts/icharts.js'
+
+    def _fetch(self, status_code, content, lines=False, decode=False):
+        session = mock.MagicMock()
+        session.get.return_value = mock.MagicMock(status_code=status_code,
+                                                  content=content)
+        with mock.patch('finam.export._get_meta_session',
+                        return_value=session), \
+                mock.patch('finam.export.fetch_url_webdriver',
+                           return_value='webdriver') as webdriver:
+            return (fetch_url_requests(self.URL, lines=lines, decode=decode),
+                    webdriver)
+
+    def test_fetch_lines(self):
+        content = smart_encode(fixtures.meta_valid)
+        actual, webdriver = self._fetch(200, content, lines=True)
+        assert actual[1].startswith(b'var aEmitentNames')
+        webdriver.assert_not_called()
+
+    def test_fetch_lines_decoded(self):
+        content = smart_encode(fixtures.meta_valid)
+        actual, _ = self._fetch(200, content, lines=True, decode=True)
+        assert actual[1].startswith('var aEmitentNames')
+
+    def test_fallback_to_webdriver(self):
+        actual, webdriver = self._fetch(403, b'', lines=True)
+        assert actual == 'webdriver'
+        webdriver.assert_called_once_with(self.URL, lines=True, decode=False)
+
+
+class TestFetchUrlUrllib(unittest.TestCase):
+
+    def test_stream_closed_on_http_error(self):
+        session = mock.MagicMock()
+        resp = session.get.return_value
+        resp.raise_for_status.side_effect = requests.HTTPError('403')
+        with self.assertRaises(FinamDownloadError):
+            fetch_url_urllib('http://example.com', stream=True,
+                             session=session)
+        resp.close.assert_called_once_with()
+
+
 class TestExporterMetaPage(unittest.TestCase):
 
     def test_find_ok(self):
@@ -37,7 +93,8 @@ class TestExporterMetaPage(unittest.TestCase):
 class TestExporterMetaFile(unittest.TestCase):
 
     def test_parse_df_ok(self):
-        fetcher = mock.MagicMock(return_value=fixtures.meta_valid__split)
+        fetcher = mock.MagicMock(
+            return_value=smart_encode(fixtures.meta_valid__split))
         meta_file = ExporterMetaFile('https://example.com', fetcher)
         actual = meta_file.parse_df()
 
@@ -54,7 +111,7 @@ class TestExporterMetaFile(unittest.TestCase):
     def test_parse_df_malformed_or_blank(self):
         for fixture in (fixtures.meta_malformed__split,
                         fixtures.meta_blank__split):
-            fetcher = mock.MagicMock(return_value=fixture)
+            fetcher = mock.MagicMock(return_value=smart_encode(fixture))
             meta_file = ExporterMetaFile('https://example.com', fetcher)
             with self.assertRaises(FinamDownloadError):
                 meta_file.parse_df()
@@ -64,7 +121,8 @@ class TestExporterMeta(unittest.TestCase):
 
     def setUp(self):
         with mock.patch('finam.export.ExporterMetaPage'):
-            fetcher = mock.MagicMock(return_value=fixtures.meta_valid__split)
+            fetcher = mock.MagicMock(
+                return_value=smart_encode(fixtures.meta_valid__split))
             self._meta = ExporterMeta(lazy=False, fetcher=fetcher)
 
     def test_lookup_by_market(self):
@@ -112,6 +170,38 @@ class TestExporterMeta(unittest.TestCase):
                     assert any(op(actual_value, asked_value)
                                for asked_value in field_values)
 
+    def test_lookup_name_with_special_chars(self):
+        for comparator in (LookupComparator.CONTAINS,
+                           LookupComparator.STARTSWITH):
+            actual = self._meta.lookup(name=['+МосЭнерго', 'CSI200 (Китай)'],
+                                       name_comparator=comparator)
+            assert {'+МосЭнерго', 'CSI200 (Китай)'} <= set(actual['name'])
+
+    def test_lookup_cached(self):
+        expected = self._meta.lookup(code=(SBER.code, MICEX.code))
+        expected['name'] = 'changed by the caller'
+        with mock.patch.object(self._meta, '_apply_filter') as apply_filter:
+            actual = self._meta.lookup(code=[MICEX.code, SBER.code])
+        apply_filter.assert_not_called()
+        assert set(actual['code']) == {SBER.code, MICEX.code}
+        assert 'changed by the caller' not in set(actual['name'])
+
+    def test_lookup_dtypes(self):
+        actual = self._meta.lookup(market=Market.SHARES)
+        assert actual['code'].dtype == object
+        assert actual['market'].dtype == int
+
+    def test_lookup_narrowed_down(self):
+        apply_filter = mock.MagicMock(wraps=self._meta._apply_filter)
+        with mock.patch.object(self._meta, '_apply_filter', apply_filter):
+            actual = self._meta.lookup(id_=SBER.id, market=Market.SHARES,
+                                       name=SBER.name)
+        assert set(actual.index) == {SBER.id}
+        # name is only matched against rows left after id and market
+        (df, col, _, _), _ = apply_filter.call_args
+        assert col == 'name'
+        assert len(df) == 1
+
     def test_lookup_by_market_and_codes(self):
         codes = SBER.code, 'GMKN'
         actual = self._meta.lookup(market=Market.SHARES, code=codes)
@@ -119,6 +209,251 @@ class TestExporterMeta(unittest.TestCase):
         assert set(actual['market']) == {Market.SHARES}
 
 
+class TestExporterMetaCache(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self._cache_path = os.path.join(tmpdir.name, 'meta', 'meta.pickle')
+        self._expected = self._load(smart_encode(fixtures.meta_valid__split))
+
+    def _load(self, response):
+        fetcher = mock.MagicMock(return_value=response)
+        with mock.patch('finam.export.ExporterMetaPage'):
+            meta = ExporterMeta(lazy=False, fetcher=fetcher,
+                                cache_path=self._cache_path)
+        return meta.meta
+
+    def _load_in_process(self, fetcher, cache_ttl):
+        with mock.patch('finam.export.ExporterMetaPage'):
+            return ExporterMeta(lazy=False, fetcher=fetcher,
+                                cache_ttl=cache_ttl)
+
+    def test_load_from_disk(self):
+        assert os.path.exists(self._cache_path)
+        # a broken response would blow up if it was actually fetched
+        actual = self._load(smart_encode(fixtures.meta_malformed__split))
+        pd.testing.assert_frame_equal(actual, self._expected)
+
+    def test_expired(self):
+        expired = os.path.getmtime(self._cache_path) - 2 * 24 * 60 * 60
+        os.utime(self._cache_path, (expired, expired))
+        with self.assertRaises(FinamDownloadError):
+            self._load(smart_encode(fixtures.meta_malformed__split))
+
+    def test_in_process(self):
+        fetcher = mock.MagicMock(
+            return_value=smart_encode(fixtures.meta_valid__split))
+        for _ in range(2):
+            self._load_in_process(fetcher, cache_ttl=60)
+        assert fetcher.call_count == 1
+
+    def test_in_process_expired(self):
+        fetcher = mock.MagicMock(
+            return_value=smart_encode(fixtures.meta_valid__split))
+        self._load_in_process(fetcher, cache_ttl=60)
+        with mock.patch('finam.export.time.time',
+                        return_value=time.time() + 120):
+            self._load_in_process(fetcher, cache_ttl=60)
+        assert fetcher.call_count == 2
+
+    def test_long_lived_instance_expired(self):
+        fetcher = mock.MagicMock(
+            return_value=smart_encode(fixtures.meta_valid__split))
+        meta = self._load_in_process(fetcher, cache_ttl=60)
+        with mock.patch('finam.export.ExporterMetaPage'):
+            meta.lookup(id_=SBER.id)
+            assert fetcher.call_count == 1
+            with mock.patch('finam.export.time.time',
+                            return_value=time.time() + 120):
+                meta.lookup(id_=SBER.id)
+        assert fetcher.call_count == 2
+
+
+class TestExporter(unittest.TestCase):
+
+    # chunk start year -> fixture returned by the fetcher
+    CHUNKS = {2017: fixtures.data_sber_daily,
+              2018: fixtures.data_sber_minutes30,
+              2019: fixtures.data_sber_monthly}
+
+    def setUp(self):
+        fetcher_meta = mock.MagicMock(
+            return_value=smart_encode(fixtures.meta_valid__split))
+        self._fetcher = mock.MagicMock(side_effect=self._fetch_chunk)
+        self._exporter = Exporter(fetcher=self._fetcher,
+                                  fetcher_meta=fetcher_meta,
+                                  meta_cache_path=None)
+        with mock.patch('finam.export.ExporterMetaPage'):
+            self._exporter.lookup(id_=SBER.id)
+
+    def _stream(self, data, chunk_size=1000):
+        data = smart_encode(data)
+        return [data[i:i + chunk_size]
+                for i in range(0, len(data), chunk_size)]
+
+    def _fetch_chunk(self, url, *args, **kwargs):
+        for year, data in self.CHUNKS.items():
+            if '&yf={}&'.format(year) in url:
+                return self._stream(data)
+        raise AssertionError('Unexpected url {}'.format(url))
+
+    def test_download_chunks_in_order(self):
+        actual = self._exporter.download(SBER.id, Market.SHARES,
+                                         start_date=date(2017, 1, 1),
+                                         end_date=date(2019, 12, 31),
+                                         timeframe=Timeframe.MINUTES1,
+                                         delay=0)
+        assert self._fetcher.call_count == len(self.CHUNKS)
+        expected = pd.concat([pd.read_csv(StringIO(data), sep=';')
+                              for data in self.CHUNKS.values()])
+        pd.testing.assert_frame_equal(actual, expected)
+
+    def test_own_session_closed(self):
+        with mock.patch('finam.export._build_session') as build_session:
+            with Exporter(meta_cache_path=None):
+                build_session.return_value.close.assert_not_called()
+        build_session.return_value.close.assert_called_once_with()
+
+    def test_download_retried_while_in_progress(self):
+        self._fetcher.side_effect = [
+            self._stream(Exporter.ERROR_ALREADY_IN_PROGRESS),
+            self._stream(fixtures.data_sber_daily),
+        ]
+        actual = self._exporter.download(SBER.id, Market.SHARES, delay=0,
+                                         start_date=date(2015, 1, 1),
+                                         end_date=date(2016, 1, 1))
+        assert self._fetcher.call_count == 2
+        assert len(actual) > 0
+
+    def test_download_blank(self):
+        self._fetcher.side_effect = None
+        self._fetcher.return_value = self._stream('')
+        actual = self._exporter.download(SBER.id, Market.SHARES, delay=0,
+                                         timeframe=Timeframe.TICKS,
+                                         start_date=date(2018, 1, 1),
+                                         end_date=date(2018, 1, 1))
+        assert len(actual) == 0
+        assert actual.columns.tolist() == ['<TICKER>', '<PER>', '<DATE>',
+                                           '<TIME>', '<LAST>', '<VOL>']
+
+    def test_download_retry_waits_after_failure(self):
+        delay = 0.2
+        attempts = []
+
+        def fetch(url, *args, **kwargs):
+            start = time.monotonic()
+            time.sleep(delay * 1.5)
+            attempts.append((start, time.monotonic()))
+            if len(attempts) < 3:
+                return self._stream(Exporter.ERROR_ALREADY_IN_PROGRESS)
+            return self._stream(fixtures.data_sber_daily)
+
+        self._fetcher.side_effect = fetch
+        self._exporter.download(SBER.id, Market.SHARES, delay=delay,
+                                start_date=date(2015, 1, 1),
+                                end_date=date(2016, 1, 1))
+        assert len(attempts) == 3
+        for (_, prev_end), (start, _) in zip(attempts, attempts[1:]):
+            assert start - prev_end >= delay * 0.9
+
+    def test_download_whole_response(self):
+        for convert in (str, smart_encode):
+            self._fetcher.side_effect = None
+            self._fetcher.return_value = convert(fixtures.data_sber_daily)
+            actual = self._exporter.download(SBER.id, Market.SHARES,
+                                             delay=0,
+                                             start_date=date(2015, 1, 1),
+                                             end_date=date(2016, 1, 1))
+            expected = pd.read_csv(StringIO(fixtures.data_sber_daily),
+                                   sep=';')
+            pd.testing.assert_frame_equal(actual, expected)
+
+    def test_download_not_csv(self):
+        self._fetcher.side_effect = None
+        self._fetcher.return_value = self._stream(fixtures.page_broken)
+        with self.assertRaises(FinamParsingError):
+            self._exporter.download(SBER.id, Market.SHARES, delay=0)
+
+    def test_download_malformed_date(self):
+        self._fetcher.side_effect = None
+        self._fetcher.return_value = self._stream(
+            Exporter.EMPTY_RESULT_NOT_TICKS
+            + '\nnot-a-date;00:00:00;1.0;1.0;1.0;1.0;1\n')
+        with self.assertRaises(FinamParsingError):
+            self._exporter.download(SBER.id, Market.SHARES, delay=0)
+
+    def test_download_throttled(self):
+        self._fetcher.side_effect = None
+        self._fetcher.return_value = self._stream(Exporter.ERROR_THROTTLING)
+        with self.assertRaises(FinamThrottlingError):
+            self._exporter.download(SBER.id, Market.SHARES, delay=0)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    INTERVAL = 0.1
+
+    def test_concurrent_slots(self):
+        limiter = RateLimiter(self.INTERVAL)
+        times = []
+        lock = threading.Lock()
+
+        def call():
+            limiter.wait()
+            with lock:
+                times.append(time.monotonic())
+
+        threads = [threading.Thread(target=call) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        times.sort()
+        assert len(times) == 4
+        for prev, cur in zip(times, times[1:]):
+            assert cur - prev >= self.INTERVAL * 0.9
+
+    def test_done_counts_from_call_end(self):
+        limiter = RateLimiter(self.INTERVAL)
+        limiter.wait()
+        time.sleep(self.INTERVAL * 2)
+        limiter.done()
+        done_at = time.monotonic()
+        limiter.wait()
+        assert time.monotonic() - done_at >= self.INTERVAL * 0.9
+
+
+class TestIterStream(unittest.TestCase):
+
+    CHUNKS = (b'abc', b'', b'defgh', b'', b'', b'ij')
+
+    def _read_all(self, size):
+        stream = IterStream(self.CHUNKS)
+        buf = bytearray(size)
+        result = b''
+        while True:
+            read = stream.readinto(buf)
+            if read == 0:
+                return result
+            assert read <= size
+            result += bytes(buf[:read])
+
+    def test_readinto(self):
+        # smaller, equal and larger than chunks
+        for size in (1, 2, 3, 5, 100):
+            assert self._read_all(size) == b''.join(self.CHUNKS)
+
+    def test_empty(self):
+        assert IterStream(()).read() == b''
+        assert IterStream((b'', b'')).read() == b''
+
+    def test_read_buffered(self):
+        stream = io.BufferedReader(IterStream(self.CHUNKS))
+        assert stream.read(4) == b'abcd'
+        assert stream.read() == b'efghij'
+
+
 class TestInterval(unittest.TestCase):
     @parameterized.expand([
         (date(2016, 1, 1), date(2020, 1, 30), Timeframe.DAILY,